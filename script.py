@@ -1,10 +1,16 @@
 import asyncio
 import datetime
+import functools
+import inspect
 import os
 import random
-from typing import Callable, Dict, Optional, Any, List, Literal
+import sys
+import threading
+from typing import Awaitable, Callable, Dict, Optional, Any, List, Literal, Tuple
 
 from dotenv import load_dotenv
+from grpclib.const import Status
+from grpclib.exceptions import GRPCError, StreamTerminatedError
 
 from viam.rpc.dial import DialOptions, Credentials
 from viam.app.viam_client import ViamClient, AppClient
@@ -24,8 +30,28 @@ PART_ID = os.getenv("PART_ID")
 MACHINE_ADDRESS = os.getenv("MACHINE_ADDRESS")
 H264_RTSP_ADDR = os.getenv("H264_RTSP_ADDR")
 H265_RTSP_ADDR = os.getenv("H265_RTSP_ADDR")
+_REQUIRED_ENV = ("API_KEY", "API_KEY_ID", "PART_ID", "MACHINE_ADDRESS", "H264_RTSP_ADDR", "H265_RTSP_ADDR")
 
+# Resolved once; the script runs for minutes, so a DST change mid-run is not a concern.
+_LOCAL_TZ = datetime.datetime.now().astimezone().tzinfo
+# Timestamp format expected by video-store's save command
+_TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S"
+# Save windows are at most 15 seconds long; index by number of seconds
+_MAX_SAVE_SECONDS = 15
+_SECONDS_DELTAS = tuple(datetime.timedelta(seconds=s) for s in range(_MAX_SAVE_SECONDS + 1))
 
+
+def validate_env() -> None:
+    """
+    Exit before touching the network if any required env var is unset, rather than failing
+    after a config update has already gone out with a bad value in it.
+    """
+    missing = [k for k in _REQUIRED_ENV if not os.getenv(k)]
+    if missing:
+        raise SystemExit(f"Missing env: {missing}. Set them in .env (see README).")
+
+
+@functools.lru_cache(maxsize=4)
 def get_rtsp_address(stream_type: RTSPStreamType = "h264") -> str:
     rtsp_addr = {
         "h264": H264_RTSP_ADDR,
@@ -38,25 +64,74 @@ def get_rtsp_address(stream_type: RTSPStreamType = "h264") -> str:
     return rtsp_addr
 
 
+# Long-lived clients shared for the whole run, created lazily by connect() and connect_machine().
+_viam_client: Optional[ViamClient] = None
+_machine: Optional[RobotClient] = None
+
+
 async def connect() -> ViamClient:
-    dial_options = DialOptions(
-        credentials=Credentials(
-            type="api-key",
-            payload=API_KEY,
-        ),
-        auth_entity=API_KEY_ID,
-    )
-    return await ViamClient.create_from_dial_options(dial_options)
+    global _viam_client
+    if _viam_client is None:
+        dial_options = DialOptions(
+            credentials=Credentials(
+                type="api-key",
+                payload=API_KEY,
+            ),
+            auth_entity=API_KEY_ID,
+        )
+        _viam_client = await ViamClient.create_from_dial_options(dial_options)
+    return _viam_client
 
 
 async def connect_machine() -> RobotClient:
-    opts = RobotClient.Options.with_api_key(
-        api_key=API_KEY,
-        api_key_id=API_KEY_ID,
-    )
-    return await RobotClient.at_address(MACHINE_ADDRESS, opts)
+    global _machine
+    if _machine is None:
+        opts = RobotClient.Options.with_api_key(
+            api_key=API_KEY,
+            api_key_id=API_KEY_ID,
+        )
+        _machine = await RobotClient.at_address(MACHINE_ADDRESS, opts)
+    return _machine
+
+
+# Static config fragments, referenced (never copied or mutated) by the builders below. Plain dicts
+# rather than MappingProxyType because the SDK's Struct conversion only accepts dicts.
+_VIAMRTSP_MODULE = {
+    "type": "registry",
+    "name": "viam_viamrtsp",
+    "module_id": "viam:viamrtsp",
+    "version": "latest-with-prerelease"
+}
+
+_VIDEO_STORE_MODULE = {
+    "type": "registry",
+    "name": "viam_video-store",
+    "module_id": "viam:video-store",
+    "version": "latest"
+}
+
+_ONVIF_DISCOVERY_SERVICE = {
+    "name": "onvif-discovery-1",
+    "api": "rdk:service:discovery",
+    "model": "viam:viamrtsp:onvif",
+    "attributes": {}
+}
+
+_DATA_MANAGER_SERVICE = {
+    "name": "data-manager-1",
+    "api": "rdk:service:data_manager",
+    "model": "rdk:builtin:builtin",
+    "attributes": {
+        "tags": [],
+        "additional_sync_paths": [],
+        "sync_interval_mins": 0.1,
+        "capture_dir": ""
+    }
+}
 
 
+# The config builders below are memoized, so callers share the returned dicts and must not mutate them.
+@functools.lru_cache(maxsize=4)
 def config_h2645(rtp_passthrough: bool, stream_type: RTSPStreamType = "h264") -> Dict[str, Any]:
     """
     Configure camera using specified RTSP stream type
@@ -79,16 +154,12 @@ def config_h2645(rtp_passthrough: bool, stream_type: RTSPStreamType = "h264") ->
             }
         ],
         "modules": [
-            {
-                "type": "registry",
-                "name": "viam_viamrtsp",
-                "module_id": "viam:viamrtsp",
-                "version": "latest-with-prerelease"
-            }
+            _VIAMRTSP_MODULE
         ]
     }
 
 
+@functools.lru_cache(maxsize=1)
 def config_onvif() -> Dict[str, Any]:
     return {
         "components": [
@@ -99,29 +170,20 @@ def config_onvif() -> Dict[str, Any]:
                 "model": "viam:viamrtsp:rtsp",
                 "attributes": {
                     "rtp_passthrough": True,
-                    "rtsp_address": get_rtsp_address(2)
+                    "rtsp_address": get_rtsp_address("h264")
                 }
             }
         ],
         "services": [
-            {
-                "name": "onvif-discovery-1",
-                "api": "rdk:service:discovery",
-                "model": "viam:viamrtsp:onvif",
-                "attributes": {}
-            }
+            _ONVIF_DISCOVERY_SERVICE
         ],
         "modules": [
-            {
-                "type": "registry",
-                "name": "viam_viamrtsp",
-                "module_id": "viam:viamrtsp",
-                "version": "latest-with-prerelease"
-            }
+            _VIAMRTSP_MODULE
         ]
     }
 
 
+@functools.lru_cache(maxsize=4)
 def config_video_store(preset: str) -> Dict[str, Any]:
     return {
         "components": [
@@ -131,7 +193,7 @@ def config_video_store(preset: str) -> Dict[str, Any]:
                 "type": "camera",
                 "model": "viam:viamrtsp:rtsp",
                 "attributes": {
-                    "rtsp_address": get_rtsp_address(2),
+                    "rtsp_address": get_rtsp_address("h264"),
                     "rtp_passthrough": True
                 }
             },
@@ -153,87 +215,274 @@ def config_video_store(preset: str) -> Dict[str, Any]:
             }
         ],
         "services": [
-            {
-                "name": "onvif-discovery-1",
-                "api": "rdk:service:discovery",
-                "model": "viam:viamrtsp:onvif",
-                "attributes": {}
-            },
-            {
-                "name": "data-manager-1",
-                "api": "rdk:service:data_manager",
-                "model": "rdk:builtin:builtin",
-                "attributes": {
-                    "tags": [],
-                    "additional_sync_paths": [],
-                    "sync_interval_mins": 0.1,
-                    "capture_dir": ""
-                }
-            }
+            _ONVIF_DISCOVERY_SERVICE,
+            _DATA_MANAGER_SERVICE
         ],
         "modules": [
-            {
-                "type": "registry",
-                "name": "viam_viamrtsp",
-                "module_id": "viam:viamrtsp",
-                "version": "latest-with-prerelease"
-            },
-            {
-                "type": "registry",
-                "name": "viam_video-store",
-                "module_id": "viam:video-store",
-                "version": "latest"
-            }
+            _VIAMRTSP_MODULE,
+            _VIDEO_STORE_MODULE
         ]
     }
 
 
-async def update_and_confirm(cloud: AppClient, part_id: str, name: str, config: Dict[str, Any], prompt: str) -> None:
-    await cloud.update_robot_part(robot_part_id=part_id, name=name, robot_config=config)
-    input(prompt)
+# gRPC statuses that mean the call may succeed if repeated; every other status is permanent
+_RETRYABLE_STATUSES = frozenset({Status.UNAVAILABLE, Status.DEADLINE_EXCEEDED})
+
+
+def is_transient_error(e: BaseException) -> bool:
+    """
+    Whether e looks like a network blip rather than a real failure of the request.
+    """
+    if isinstance(e, GRPCError):
+        return e.status in _RETRYABLE_STATUSES
+    return isinstance(e, (StreamTerminatedError, OSError))
+
+
+async def retry_async(fn: Callable[..., Awaitable[Any]], *args: Any, retries: int = 3, base: float = 1.0,
+                      cap: float = 30.0, jitter: float = 0.5,
+                      is_transient: Callable[[BaseException], bool] = is_transient_error,
+                      **kwargs: Any) -> Any:
+    """
+    Await fn(*args, **kwargs), retrying transient errors with exponential backoff and jitter.
+
+    Only use this for idempotent calls, since a timed out request may already have been applied.
+    Errors is_transient rejects are raised immediately, as is the last error once retries run out.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            delay = min(cap, base * 2 ** attempt) * (1 + random.uniform(0, jitter))
+            print(f"{getattr(fn, '__name__', fn)} failed (attempt {attempt + 1}/{retries + 1}). "
+                  f"Retrying in {delay:.2f}s. Error: {e}")
+            await asyncio.sleep(delay)
+
 
+def _read_stdin_line() -> str:
+    """
+    Read one line from the raw stdin fd. Unlike input(), this holds no lock on sys.stdin while
+    blocked, so interpreter shutdown isn't stuck behind, or aborted by, a pending read.
+    """
+    line = bytearray()
+    while not line.endswith(b"\n"):
+        chunk = os.read(sys.stdin.fileno(), 1)
+        if not chunk:
+            if line:
+                break
+            raise EOFError("EOF when reading a line")
+        line += chunk
+    return line.decode().rstrip("\r\n")
+
+
+def _resolve(future: asyncio.Future, result: Any = None, exc: Optional[BaseException] = None) -> None:
+    if future.done():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+async def prompt_user(prompt: str) -> str:
+    """
+    Wait for the user to press Enter without blocking the event loop, so gRPC keepalives keep flowing.
 
-async def wait_for_resource(machine: RobotClient, resource_getter: Callable[[], Any], resource_name: str) -> Any:
-    resource = None
-    while not resource:
+    The read runs on a daemon thread rather than the default executor, so Ctrl-C at a prompt exits
+    right away instead of asyncio.run waiting for the blocked read during shutdown.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def read() -> None:
         try:
-            resource = resource_getter()
+            line = _read_stdin_line()
+        except Exception as e:
+            loop.call_soon_threadsafe(_resolve, future, None, e)
+        else:
+            loop.call_soon_threadsafe(_resolve, future, line)
+
+    print(prompt, end="", flush=True)
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+
+async def update_and_confirm(cloud: AppClient, part_id: str, name: str, config: Dict[str, Any], prompt: str,
+                             machine: Optional[RobotClient] = None) -> None:
+    """
+    Push a config update and wait for the user to confirm it. If a machine is given, it is refreshed
+    after the user continues, by which point viam-server has had time to apply the new config.
+    """
+    await retry_async(cloud.update_robot_part, robot_part_id=part_id, name=name, robot_config=config)
+    await prompt_user(prompt)
+    if machine is not None:
+        await safe_refresh_machine(machine)
+
+
+async def update_and_confirm_steps(cloud: AppClient, part_id: str, name: str,
+                                   steps: List[Tuple[str, Dict[str, Any], str]]) -> None:
+    """
+    Run a sequence of config updates, each gated on the user confirming the previous one.
+
+    Args:
+        steps: (message, config, prompt) tuples, applied in order
+    """
+    for message, config, prompt in steps:
+        print(message)
+        await update_and_confirm(cloud, part_id, name, config, prompt)
+
+
+# Poll densely right after a config update, then taper off. The last entry repeats forever.
+_POLL_DELAYS = (0, 0.1, 0.25, 0.5, 1, 2, 4, 8, 10)
+
+
+def tapering_delay(attempt: int) -> float:
+    return _POLL_DELAYS[min(attempt, len(_POLL_DELAYS) - 1)]
+
+
+async def wait_until(condition: Callable[[], Any], *, max_wait: float = 120.0,
+                     delay_strategy: Callable[[int], float] = tapering_delay,
+                     wake: Optional[Callable[[int], Optional[asyncio.Future]]] = None,
+                     description: str = "condition") -> Any:
+    """
+    Call condition until it returns something truthy and return that result.
+
+    Args:
+        condition: Sync or async callable checked on every attempt
+        max_wait: Seconds to keep trying before raising TimeoutError
+        delay_strategy: Maps the attempt number to a delay in seconds
+        wake: Called with the attempt number before each sleep; if it returns a pending future,
+            the sleep ends as soon as that future completes
+        description: Used in the timeout message
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    attempt = 0
+    while True:
+        result = condition()
+        if inspect.isawaitable(result):
+            result = await result
+        if result:
+            return result
+        if loop.time() - start > max_wait:
+            raise TimeoutError(f"{description} not met after {max_wait} seconds")
+        delay = delay_strategy(attempt)
+        attempt += 1
+        waker = wake(attempt) if wake else None
+        if waker is None or waker.done():
+            await asyncio.sleep(delay)
+            continue
+        sleep_task = asyncio.create_task(asyncio.sleep(delay))
+        try:
+            await asyncio.wait({sleep_task, waker}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            sleep_task.cancel()
+
+
+async def wait_for_resource(machine: RobotClient, resource_getter: Callable[[], Any], resource_name: str,
+                            max_wait: float = 120.0) -> Any:
+    """
+    Wait until resource_getter stops raising ResourceNotFoundError and return the resource.
+
+    The SDK has no resource-change notification to await, so this polls through wait_until. A machine
+    refresh walks the whole resource graph, so one is only started on attempts 1, 2, 4, 8, ...
+    and an in-flight refresh wakes the waiter as soon as it completes.
+
+    Args:
+        machine: Machine to refresh while waiting
+        resource_getter: Callable returning the resource or raising ResourceNotFoundError
+        resource_name: Name used in log messages
+        max_wait: Seconds to keep trying before giving up
+    """
+    refresh_task: Optional[asyncio.Task] = None
+
+    def try_get() -> Any:
+        try:
+            return resource_getter()
         except ResourceNotFoundError as e:
-            print(f"{resource_name} resource not found yet. Sleeping then trying again. Error: {e}")
-            await asyncio.sleep(1)
-            await safe_refresh_machine(machine)
-    return resource
+            print(f"{resource_name} resource not found yet. Trying again. Error: {e}")
+            return None
+
+    def refresh(attempt: int) -> Optional[asyncio.Task]:
+        nonlocal refresh_task
+        if attempt & (attempt - 1) == 0 and (refresh_task is None or refresh_task.done()):
+            refresh_task = asyncio.create_task(safe_refresh_machine(machine))
+        return refresh_task
+
+    try:
+        return await wait_until(try_get, max_wait=max_wait, wake=refresh, description=f"{resource_name} resource")
+    finally:
+        # Don't leave our refresh running unowned; the shared refresh it waits on carries on for other callers
+        if refresh_task is not None and not refresh_task.done():
+            refresh_task.cancel()
+
+
+# The refresh currently in flight, shared by all callers of safe_refresh_machine
+_refresh_task: Optional[asyncio.Task] = None
 
 
 async def safe_refresh_machine(machine: RobotClient) -> None:
     """
     Safely refresh the machine connection, swallowing and logging any errors.
+
+    Concurrent callers share a single in-flight refresh instead of stacking up duplicate ones.
     """
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.create_task(machine.refresh())
     try:
-        await machine.refresh()
+        # shield so one caller being cancelled doesn't cancel the refresh for everyone else
+        await asyncio.shield(_refresh_task)
     except Exception as e:
         print(f"Got error while refreshing machine. Continuing anyway. Error: {e}")
 
 
+async def _warmup(camera: Camera, duration: float, interval: float = 5.0, max_failures: int = 3) -> None:
+    """
+    Pull frames from camera every interval seconds for duration seconds, raising once max_failures
+    consecutive pulls fail so a dead stream is caught before video-store is asked to save it.
+    A pull that takes longer than interval counts as a failure, so a stalled stream can't hold up the test.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    failures = 0
+    while loop.time() < deadline:
+        try:
+            await asyncio.wait_for(camera.get_image(), interval)
+            failures = 0
+        except Exception as e:
+            failures += 1
+            reason = f"no image within {interval}s" if isinstance(e, asyncio.TimeoutError) else e
+            print(f"Failed to get an image from {camera.name} ({failures}/{max_failures}). Error: {reason}")
+            if failures >= max_failures:
+                raise RuntimeError(f"{camera.name} is not producing frames; video-store would have nothing to save") from e
+        await asyncio.sleep(min(interval, max(0.0, deadline - loop.time())))
+
+
 async def test_video_store_preset(cloud: AppClient, part_id: str, robot_part_name: str, machine: RobotClient, preset: str, sleep_time: int = 30) -> Camera:
     """Test video-store with a specific preset configuration."""
     print(f"Testing video-store with '{preset}' preset.")
     await update_and_confirm(cloud, part_id, robot_part_name, config_video_store(preset),
-                          f"Video-store config updated with {preset} preset. Enter/Return to continue.")
-    await safe_refresh_machine(machine)
+                          f"Video-store config updated with {preset} preset. Enter/Return to continue.", machine)
     
     vid_store: Camera = await wait_for_resource(machine, 
                                      lambda: Camera.from_robot(machine, "video-store-1"),
                                      "video-store-1")
     
+    rtsp_cam: Camera = await wait_for_resource(machine,
+                                               lambda: Camera.from_robot(machine, "rtsp-cam-1"),
+                                               "rtsp-cam-1", max_wait=sleep_time)
+
     print(f"Connected to video-store, sleeping for {sleep_time} seconds to get some video playback before saving.")
-    await asyncio.sleep(sleep_time)
+    # Check the source stream while we wait so a broken pipeline fails now rather than at save time
+    await _warmup(rtsp_cam, sleep_time)
     
-    now = datetime.datetime.now().astimezone()
-    random_seconds = random.randint(2, min(15, sleep_time-1))
-    from_time = now - datetime.timedelta(seconds=random_seconds)
-    now_str = now.strftime("%Y-%m-%d_%H-%M-%S")
-    from_str = from_time.strftime("%Y-%m-%d_%H-%M-%S")
+    now = datetime.datetime.now(_LOCAL_TZ)
+    random_seconds = random.randrange(2, min(_MAX_SAVE_SECONDS, sleep_time-1) + 1)
+    from_time = now - _SECONDS_DELTAS[random_seconds]
+    now_str = now.strftime(_TIMESTAMP_FORMAT)
+    from_str = from_time.strftime(_TIMESTAMP_FORMAT)
     
     cmd = {
         "command": "save",
@@ -243,59 +492,70 @@ async def test_video_store_preset(cloud: AppClient, part_id: str, robot_part_nam
         "async": True,
     }
     print(f"Sending save command. {cmd}")
+    # Not retried: save isn't idempotent, and a timed out save may already have reached video-store
     await vid_store.do_command(cmd)
-    input(f"Verify playback of the saved video with {preset} preset on App now.")
+    await prompt_user(f"Verify playback of the saved video with {preset} preset on App now.")
     
     return vid_store
 
 
 async def main() -> None:
-    viam_client = await connect()
-    cloud = viam_client.app_client
-    part = await cloud.get_robot_part(robot_part_id=PART_ID)
-
-    # Test h264 stream with rtp_passthrough = True
-    print("Setting config to have h264 camera with rtp_passthrough.")
-    await update_and_confirm(cloud, PART_ID, part.name, config_h2645(True, stream_type="h264"),
-                             "Please confirm that the stream works with rtp_passthrough before continuing.")
-
-    # Test h264 stream with rtp_passthrough = False
-    print("Cool. Moving onto without passthrough.")
-    await update_and_confirm(cloud, PART_ID, part.name, config_h2645(False, stream_type="h264"),
-                             "Please confirm that the stream works without rtp_passthrough before continuing.")
-
-    # Test h265 stream with passthrough True
-    print("Ok now testing stream with h265.")
-    await update_and_confirm(cloud, PART_ID, part.name, config_h2645(True, stream_type="h265"),
-                             "Please confirm that the h265 stream works.")
+    # Dial the machine while the cloud connection and part lookup are in flight
+    machine_task = asyncio.create_task(connect_machine())
+    try:
+        viam_client = await connect()
+        cloud = viam_client.app_client
+        part, machine = await asyncio.gather(cloud.get_robot_part(robot_part_id=PART_ID), machine_task)
+        await run_tests(cloud, part.name, machine)
+    finally:
+        # If startup failed before the dial finished, stop it, and collect its outcome either way so a
+        # failed dial isn't reported as an unretrieved task exception
+        if not machine_task.done():
+            machine_task.cancel()
+        await asyncio.gather(machine_task, return_exceptions=True)
+        if _viam_client:
+            _viam_client.close()
+        if _machine:
+            await _machine.close()
+
+
+async def run_tests(cloud: AppClient, part_name: str, machine: RobotClient) -> None:
+    # Test h264 with and without rtp_passthrough, then h265 with passthrough
+    await update_and_confirm_steps(cloud, PART_ID, part_name, [
+        ("Setting config to have h264 camera with rtp_passthrough.",
+         config_h2645(True, stream_type="h264"),
+         "Please confirm that the stream works with rtp_passthrough before continuing."),
+        ("Cool. Moving onto without passthrough.",
+         config_h2645(False, stream_type="h264"),
+         "Please confirm that the stream works without rtp_passthrough before continuing."),
+        ("Ok now testing stream with h265.",
+         config_h2645(True, stream_type="h265"),
+         "Please confirm that the h265 stream works."),
+    ])
 
     # Test ONVIF discovery
     print("Okay now we need to test ONVIF discovery")
-    await update_and_confirm(cloud, PART_ID, part.name, config_onvif(),
-                             "ONVIF config updated. Enter/return to continue.")
+    await update_and_confirm(cloud, PART_ID, part_name, config_onvif(),
+                             "ONVIF config updated. Enter/return to continue.", machine)
 
-    machine = await connect_machine()
     onvif_discovery: DiscoveryClient = await wait_for_resource(machine, lambda: DiscoveryClient.from_robot(machine, "onvif-discovery-1"),
                                               "onvif discovery")
     print("Connected to discovery service. Running discover resources...")
     result = await onvif_discovery.discover_resources()
     print(result)
-    input("Verify the above discovery results.")
+    await prompt_user("Verify the above discovery results.")
 
     # Test video-store with different presets
     print("Okay. Moving onto video-store.")
-    vid_store = await test_video_store_preset(cloud, PART_ID, part.name, machine, "medium")
+    vid_store = await test_video_store_preset(cloud, PART_ID, part_name, machine, "medium")
     
     print("Reconfiguring to ultrafast preset and re-testing.")
     await vid_store.close()  # close previous connection before creating a new one
-    _ = await test_video_store_preset(cloud, PART_ID, part.name, machine, "ultrafast")
+    _ = await test_video_store_preset(cloud, PART_ID, part_name, machine, "ultrafast")
 
-    if viam_client:
-        await viam_client.close()
-    if machine:
-        await machine.close()
     print("All tests ran. byebye")
 
 
 if __name__ == '__main__':
+    validate_env()
     asyncio.run(main())